@@ -1,14 +1,41 @@
+import os
+import operator
+from typing import Annotated, TypedDict
+from langgraph.graph import StateGraph, START, END
 from langgraph.prebuilt import create_react_agent
+from langgraph.types import Send
 from app.model import get_gemini_model
+from app.services.processor import new_batch_id
 from app.tools.sticker_tool import (
     generate_image_tool, 
     check_background_tool, 
     remove_background_tool, 
     resize_image_tool,
     image_to_image_tool,
-    read_prompt_file_tool
+    read_prompt_file_tool,
+    get_processor
 )
 
+STICKER_AGENT_PROMPT = """You are an expert sticker creation assistant. You MUST complete ALL steps below for EVERY request — never stop after just one step.
+
+Workflow (execute ALL steps in order):
+0. READ PROMPT FILE (if applicable): If the user mentions a JSON file or prompt file, call 'read_prompt_file' FIRST to parse it. Then use the parsed output to call the appropriate generation tool.
+1. GENERATE: Create the image.
+   - Use 'generate_image' for text-to-image requests.
+   - Use 'image_to_image' when the user provides a local base image.
+2. CHECK BACKGROUND: After generating, ALWAYS call 'check_image_background' on the generated image.
+3. REMOVE BACKGROUND: If the check returns 'has_background', call 'remove_background' on the image.
+4. RESIZE: ALWAYS call 'resize_for_sticker' on the final image (after background removal if it was needed, or directly on the generated image if it was already transparent).
+
+CRITICAL RULES:
+- You MUST call all tools in sequence. Do NOT stop after generating the image.
+- After each tool call, immediately proceed to the next step.
+- If a user mentions a .json file, ALWAYS call 'read_prompt_file' first.
+- If a user mentions a local file, assume it is in the 'data/input' directory unless specified otherwise.
+- JSON prompt files are in the 'data/prompts' directory by default.
+- Use the file path returned by each tool as input for the next tool.
+- Be concise in your responses."""
+
 def create_sticker_agent():
     """
     Creates and returns a LangGraph agent specialized in sticker creation.
@@ -38,25 +65,85 @@ def create_sticker_agent():
     agent_graph = create_react_agent(
         model=llm, 
         tools=tools,
-        prompt="""You are an expert sticker creation assistant. You MUST complete ALL steps below for EVERY request — never stop after just one step.
+        prompt=STICKER_AGENT_PROMPT
+    )
 
-Workflow (execute ALL steps in order):
-0. READ PROMPT FILE (if applicable): If the user mentions a JSON file or prompt file, call 'read_prompt_file' FIRST to parse it. Then use the parsed output to call the appropriate generation tool.
-1. GENERATE: Create the image.
-   - Use 'generate_image' for text-to-image requests.
-   - Use 'image_to_image' when the user provides a local base image.
-2. CHECK BACKGROUND: After generating, ALWAYS call 'check_image_background' on the generated image.
-3. REMOVE BACKGROUND: If the check returns 'has_background', call 'remove_background' on the image.
-4. RESIZE: ALWAYS call 'resize_for_sticker' on the final image (after background removal if it was needed, or directly on the generated image if it was already transparent).
+    return agent_graph
 
-CRITICAL RULES:
-- You MUST call all tools in sequence. Do NOT stop after generating the image.
-- After each tool call, immediately proceed to the next step.
-- If a user mentions a .json file, ALWAYS call 'read_prompt_file' first.
-- If a user mentions a local file, assume it is in the 'data/input' directory unless specified otherwise.
-- JSON prompt files are in the 'data/prompts' directory by default.
-- Use the file path returned by each tool as input for the next tool.
-- Be concise in your responses."""
+
+# --- Batch Sticker Graph ---
+
+class StickerBatchState(TypedDict):
+    prompts: list[str]
+    generated: Annotated[list[dict], operator.add]
+    results: list[dict]
+
+class StickerJobState(TypedDict):
+    index: int
+    prompt: str
+    name: str
+
+def _fan_out_prompts(state: StickerBatchState):
+    """Sends every prompt to its own generate_image run."""
+    if not state["prompts"]:
+        return "finish_stickers"
+    batch_id = new_batch_id()
+    return [
+        Send("generate_image", {"index": i, "prompt": prompt, "name": f"{batch_id}_{i}"})
+        for i, prompt in enumerate(state["prompts"])
+    ]
+
+def _generate_image(state: StickerJobState):
+    """Generates the base image for one prompt."""
+    job = {"index": state["index"], "prompt": state["prompt"], "name": state["name"]}
+    try:
+        output_path = os.path.join("data", "input", f"{state['name']}.png")
+        job["source"] = get_processor().generate_image(state["prompt"], output_path)
+    except Exception as e:
+        job["error"] = str(e)
+    return {"generated": [job]}
+
+def _finish_stickers(state: StickerBatchState):
+    """Removes backgrounds and resizes all generated images in one batch."""
+    jobs = sorted(state.get("generated", []), key=lambda job: job["index"])
+    ready = [job for job in jobs if "source" in job]
+    finished = get_processor().finish_stickers(
+        [(job["source"], os.path.join("data", "output", f"{job['name']}_resized.png")) for job in ready],
+        return_exceptions=True
     )
+    for job, result in zip(ready, finished):
+        if isinstance(result, Exception):
+            job["error"] = str(result)
+        else:
+            job["path"] = result
 
-    return agent_graph
+    results = []
+    for job in jobs:
+        if "error" in job:
+            results.append({"prompt": job["prompt"], "error": job["error"]})
+        else:
+            results.append({"prompt": job["prompt"], "path": job["path"]})
+    return {"results": results}
+
+def create_batch_sticker_graph():
+    """
+    Creates a LangGraph graph that turns a list of prompts into stickers.
+    
+    Unlike the ReAct agent, the workflow is fixed, so no LLM round-trips are
+    needed between steps. Each prompt is fanned out with Send to generate its
+    image concurrently with the others; the generated images are then joined
+    and go through background removal and resizing together, so the
+    segmentation model runs in batches instead of once per concurrent branch.
+    Files are named after a per-run batch id, so runs don't overwrite each other.
+    The per-prompt results are returned in prompt order in 'results'.
+    
+    Usage:
+        graph.invoke({"prompts": ["a happy cat", "a waving bear"]})
+    """
+    builder = StateGraph(StickerBatchState)
+    builder.add_node("generate_image", _generate_image)
+    builder.add_node("finish_stickers", _finish_stickers)
+    builder.add_conditional_edges(START, _fan_out_prompts, ["generate_image", "finish_stickers"])
+    builder.add_edge("generate_image", "finish_stickers")
+    builder.add_edge("finish_stickers", END)
+    return builder.compile()
@@ -1,12 +1,15 @@
 import os
+from functools import lru_cache
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
+@lru_cache(maxsize=4)
 def get_gemini_model(model_name="gemini-2.5-flash"):
     """
     Initializes and returns the Gemini Chat Model.
+    The instance is cached per model name and shared between agents.
     Ensure GOOGLE_API_KEY is set in your .env file.
     """
     api_key = os.getenv("GOOGLE_API_KEY")
@@ -16,6 +19,5 @@ def get_gemini_model(model_name="gemini-2.5-flash"):
     return ChatGoogleGenerativeAI(
         model=model_name,
         google_api_key=api_key,
-        temperature=0,
-        convert_system_message_to_human=True
+        temperature=0
     )
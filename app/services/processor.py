@@ -1,83 +1,466 @@
+import os
+
+# Split the cores between OpenCV and torch/BLAS so their thread pools don't
+# oversubscribe the CPU. The BLAS variables must be set before torch is imported.
+_CPU_COUNT = os.cpu_count() or 1
+_CV_THREADS = max(1, _CPU_COUNT // 2)
+_TORCH_THREADS = max(1, _CPU_COUNT - _CV_THREADS)
+os.environ.setdefault("OMP_NUM_THREADS", str(_TORCH_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(_TORCH_THREADS))
+
 import cv2
 import numpy as np
 from PIL import Image
-from transformers import pipeline
-import os
-import requests
-import base64
+import asyncio
+import httpx
 import io
+import hashlib
+import mmap
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 from dotenv import load_dotenv
 try:
-    from google import genai
-    from google.genai import types
+    import pyvips
+except (ImportError, OSError):
+    # pyvips is optional and also needs the libvips shared library
+    pyvips = None
+try:
+    # SIMD-accelerated drop-in for the stdlib base64 module
+    import pybase64 as base64
+except ImportError:
+    import base64
+try:
+    # SIMD tree hashing, several times faster than SHA-2 on large images
+    from blake3 import blake3 as _content_hash
 except ImportError:
-    genai = None
+    _content_hash = hashlib.blake2b
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Imagen calls share pooled keep-alive connections instead of a new TLS handshake per request
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20)
+_HTTP = httpx.Client(http2=True, timeout=60, limits=_HTTP_LIMITS)
+
+
+def _file_digest(path):
+    """
+    Content hash of a file, used to key cached results.
+    Memoized on (path, mtime, size), so repeated calls on an unchanged file
+    (e.g. agent retries) cost a stat instead of a full read.
+    """
+    st = os.stat(path)
+    return _hash_file(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+@lru_cache(maxsize=256)
+def _hash_file(path, mtime_ns, size):
+    """
+    Hashes a file's content. Files over 1MB are hashed through mmap
+    instead of being read into memory.
+    """
+    with open(path, "rb") as f:
+        if size > (1 << 20):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _content_hash(data).hexdigest()
+        return _content_hash(f.read()).hexdigest()
+
+
+# RMBG-1.4 segments at 1024x1024, whatever the input size
+_MODEL_SIDE = 1024
+
+# libjpeg can decode straight to 1/8, 1/4 or 1/2 scale in its IDCT
+_REDUCED_JPEG_READS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _read_rgb(path, min_side=None):
+    """
+    Reads an image file straight into an HxWx3 RGB uint8 array.
+    EXIF orientation is ignored, matching PIL's Image.open.
+    With min_side, large JPEGs are decoded at the smallest reduced scale
+    that keeps both sides at least min_side pixels.
+    """
+    flags = cv2.IMREAD_COLOR
+    if min_side:
+        # Header only: PIL doesn't decode pixels until asked
+        with Image.open(path) as header:
+            if header.format == "JPEG":
+                short_side = min(header.size)
+                for factor, reduced in _REDUCED_JPEG_READS:
+                    if short_side // factor >= min_side:
+                        flags = reduced
+                        break
+    img = cv2.imread(path, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise ValueError(f"Could not read image: {path}")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+
+
+def _write_rgba(path, rgba, compression=1):
+    """
+    Writes an HxWx4 RGBA uint8 array as PNG with OpenCV.
+    The array is swapped to BGRA in place, so pass a buffer you no longer need.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA, dst=rgba)
+    if not cv2.imwrite(path, rgba, [cv2.IMWRITE_PNG_COMPRESSION, compression]):
+        raise ValueError(f"Could not write image: {path}")
+    return path
+
+
+# Part of every result cache key. Bump it whenever remove_background or
+# resize_image output changes, so entries written by older code stop matching.
+_CACHE_VERSION = 2
+
+
+def new_batch_id():
+    """
+    Unique file name prefix for one batch run (e.g. "batch_20260101-120000_3f9a1c"),
+    so consecutive runs don't overwrite each other's inputs and stickers.
+    """
+    return f"batch_{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+
+@lru_cache(maxsize=1)
+def _load_genai():
+    """
+    Imports the google-genai SDK on first use.
+    Returns (genai, types), or (None, None) if the package is not installed.
+    """
+    try:
+        from google import genai
+        from google.genai import types
+    except ImportError:
+        return None, None
+    return genai, types
+
+
+@contextmanager
+def _torch_inference(device_type="cpu"):
+    """
+    Runs the block under torch.inference_mode.
+    On CUDA it also runs under fp16 autocast: the weights stay fp32 and autocast
+    casts per op, so the pipeline's fp32 input tensors are accepted.
+    """
+    import torch
+
+    autocast = torch.autocast("cuda", dtype=torch.float16) if device_type == "cuda" else nullcontext()
+    with torch.inference_mode(), autocast:
+        yield
+
+
+@lru_cache(maxsize=64)
+def _fit_size(src_w, src_h, target_w, target_h):
+    """
+    Shrink-only size and interpolation for fitting src inside the target box.
+    INTER_AREA for 2x or larger reductions (no aliasing, cheaper), LANCZOS4 otherwise.
+    """
+    scale = min(target_w / src_w, target_h / src_h, 1.0)
+    new_size = (max(1, round(src_w * scale)), max(1, round(src_h * scale)))
+    interpolation = cv2.INTER_AREA if scale <= 0.5 else cv2.INTER_LANCZOS4
+    return new_size, interpolation
+
+
+# Serializes model loading when the pipeline is first requested from several threads
+_PIPE_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=2)
+def _get_pipe(model_name):
+    """
+    Loads the segmentation pipeline once per model name and shares it
+    across StickerProcessor instances.
+    torch and transformers are only imported here, on first use.
+    """
+    import torch
+    from transformers import pipeline
+
+    # torch's intra-op thread count is process-global, so it is set once here
+    # (its share of the cores) rather than toggled around each call
+    torch.set_num_threads(_TORCH_THREADS)
+
+    # Run on the GPU (CUDA or Apple MPS) when available. The weights stay fp32:
+    # the RMBG pipeline always builds fp32 input tensors, which fp16 weights reject.
+    if torch.cuda.is_available():
+        device, device_name = 0, "cuda"
+    elif torch.backends.mps.is_available():
+        device, device_name = "mps", "mps"
+    else:
+        device, device_name = -1, "cpu"
+    print(f"Loading model {model_name} ({device_name}, fp32)...")
+    pipe = pipeline(
+        "image-segmentation",
+        model=model_name,
+        device=device,
+        torch_dtype=torch.float32,
+        trust_remote_code=True
+    )
+    pipe.model.eval()
+    if device_name != "mps":
+        # NHWC weights let cuDNN / oneDNN use their faster channels-last conv kernels
+        pipe.model.to(memory_format=torch.channels_last)
+    if device_name == "cuda":
+        # Inputs are always resized to the model's fixed size, so the autotuned algorithms stay valid
+        torch.backends.cudnn.benchmark = True
+    return pipe
+
+
 class StickerProcessor:
     """
     Sticker Processor Service.
     Handles image generation, background removal, and resizing as separate operations.
     """
     
-    def __init__(self, model_name="briaai/RMBG-1.4"):
-        print(f"Loading model {model_name}...")
-        self.pipe = pipeline("image-segmentation", model=model_name, trust_remote_code=True)
+    def __init__(self, model_name="briaai/RMBG-1.4", cache_dir=os.path.join("data", "cache")):
+        # The model is loaded on first use of self.pipe
+        self.model_name = model_name
+        cv2.setNumThreads(_CV_THREADS)
+        
+        # Results of remove_background/resize_image keyed by input content + params (None disables)
+        self.cache_dir = cache_dir
+        # Model name as a file-name-safe cache key part ("briaai/RMBG-1.4" -> "briaai--RMBG-1.4")
+        self._model_key = re.sub(r"[^\w.-]", "_", model_name.replace("/", "--"))
         
         # Initialize API keys from environment
         self.google_api_key = os.getenv("GOOGLE_API_KEY")
         
-        # Initialize Google GenAI Client (Nano Banana)
-        if genai and self.google_api_key:
-            self.client = genai.Client(api_key=self.google_api_key)
-        else:
-            self.client = None
+        # Google GenAI Client (Nano Banana), created on first use
+        self._client = None
+        
+        # Per-thread mask buffers reused across _clean_cutout calls, keyed by image shape
+        self._scratch = threading.local()
+
+    @property
+    def pipe(self):
+        """
+        The shared RMBG segmentation pipeline.
+        """
+        with _PIPE_LOCK:
+            return _get_pipe(self.model_name)
 
-    def remove_background(self, input_path, output_path, erosion_size=1, island_size=50):
+    def _inference(self):
+        """
+        Inference context for self.pipe on the device it was loaded on.
+        """
+        return _torch_inference(self.pipe.device.type)
+
+    def warm_up(self):
+        """
+        Loads the model and runs one tiny inference so the first real call
+        doesn't pay for lazy initialization (e.g. CUDA kernel setup).
+        """
+        with self._inference():
+            self.pipe(Image.new("RGB", (64, 64)))
+
+    @property
+    def client(self):
+        """
+        The google-genai client, or None if the SDK or GOOGLE_API_KEY is missing.
+        """
+        if self._client is None and self.google_api_key:
+            genai, _ = _load_genai()
+            if genai:
+                self._client = genai.Client(api_key=self.google_api_key)
+        return self._client
+
+    def remove_background(self, input_path, output_path, erosion_size=1, island_size=50, denoise=False):
         """
         Removes background and cleans up edges/noise.
+        Non-local means content denoising is expensive and off by default;
+        pass denoise=True to run it on the RGB channels.
         """
         if not os.path.exists(input_path):
             raise FileNotFoundError(f"Input file not found: {input_path}")
             
+        cache_path = self._cache_path("nobg", input_path, self._model_key, erosion_size, island_size, denoise)
+        if self._restore_cached(cache_path, output_path):
+            print(f"Using cached background removal: {input_path}")
+            return output_path
+
         print(f"Removing background: {input_path}")
-        image = Image.open(input_path).convert("RGB")
-        img_np = np.array(image)
-        
-        # Background Removal
-        result_rgba = self.pipe(image)
-        result_np = np.array(result_rgba)
-        r, g, b, a = cv2.split(result_np)
+        img_np = _read_rgb(input_path)
+        final_rgba = self.remove_background_array(img_np, erosion_size, island_size, denoise)
+        # Fast, light compression: this is usually an intermediate file that gets resized next
+        _write_rgba(output_path, final_rgba, compression=1)
+        self._store_cached(output_path, cache_path)
+        return output_path
+
+    def remove_background_batch(self, inputs, erosion_size=1, island_size=50, denoise=False, batch_size=8):
+        """
+        Batched variant of remove_background for a list of (input_path, output_path) pairs.
+        Uncached inputs go through the segmentation model batch_size images per forward pass.
+        """
+        pending = []
+        for input_path, output_path in inputs:
+            if not os.path.exists(input_path):
+                raise FileNotFoundError(f"Input file not found: {input_path}")
+            cache_path = self._cache_path("nobg", input_path, self._model_key, erosion_size, island_size, denoise)
+            if self._restore_cached(cache_path, output_path):
+                print(f"Using cached background removal: {input_path}")
+            else:
+                pending.append((input_path, output_path, cache_path))
+
+        if pending:
+            print(f"Removing background from {len(pending)} image(s)")
+        images = [_read_rgb(input_path) for input_path, _, _ in pending]
+        results = self.remove_background_arrays(images, erosion_size, island_size, denoise, batch_size)
+        for (_, output_path, cache_path), final_rgba in zip(pending, results):
+            _write_rgba(output_path, final_rgba, compression=1)
+            self._store_cached(output_path, cache_path)
+        return [output_path for _, output_path in inputs]
+
+    def remove_background_array(self, img_np, erosion_size=1, island_size=50, denoise=False, smooth=True):
+        """
+        In-memory variant of remove_background.
+        Takes an HxWx3 RGB uint8 array and returns an HxWx4 RGBA array.
+        """
+        return self.remove_background_arrays([img_np], erosion_size, island_size, denoise, smooth=smooth)[0]
+
+    def remove_background_arrays(self, images, erosion_size=1, island_size=50, denoise=False, batch_size=8, smooth=True):
+        """
+        In-memory variant of remove_background_batch.
+        Segments the RGB arrays batch_size at a time in one forward pass each, then cleans each mask.
+        Pass smooth=False when the result is downscaled afterwards: the resize
+        filter already softens the edges, so the 3x3 edge blur is wasted work.
+        """
+        return [
+            self._clean_cutout(img_np, a, erosion_size, island_size, denoise, smooth)
+            for img_np, a in zip(images, self._segment(images, batch_size))
+        ]
+
+    def _segment(self, images, batch_size=8):
+        """
+        Runs the segmentation model on RGB arrays and returns their predicted alphas.
+        RMBG's custom pipeline has no feature extractor, so transformers can't collate
+        a batch for it: the pipeline's own preprocess/postprocess run per image around
+        a single model call on the concatenated tensors.
+        """
+        import torch
+
+        pipe = self.pipe
+        alphas = []
+        with self._inference():
+            for start in range(0, len(images), batch_size):
+                chunk = [Image.fromarray(img) for img in images[start:start + batch_size]]
+                if len(chunk) == 1:
+                    results = [pipe(chunk[0])]
+                else:
+                    try:
+                        items = [pipe.preprocess(image) for image in chunk]
+                        batch = torch.cat([item.pop("preprocessed_image") for item in items]).to(pipe.device)
+                        outputs = pipe.model(batch)
+                        results = []
+                        for i, item in enumerate(items):
+                            # The model returns a tuple of lists of (N, ...) tensors: hand each
+                            # image its own slice, postprocessed back to its original size
+                            item["result"] = tuple([t[i:i + 1] for t in part] for part in outputs)
+                            results.append(pipe.postprocess(item))
+                    except Exception as e:
+                        print(f"Batched segmentation failed ({e}), segmenting one image at a time")
+                        results = [pipe(image) for image in chunk]
+                # Only the predicted alpha is used; the RGB comes from the input array
+                alphas.extend(np.asarray(result.getchannel("A")) for result in results)
+        return alphas
+
+    def _clean_cutout(self, img_np, a, erosion_size, island_size, denoise, smooth=True):
+        """
+        Cleans the segmentation alpha (islands, halo, edges) and merges it with
+        the original (optionally denoised) RGB content into a new RGBA array.
+        """
+        h, w = a.shape
+        h2, w2 = (h + 1) // 2, (w + 1) // 2
+        buf = self._scratch_buffers(h, w)
         
-        # Island Removal (Denoising mask)
-        _, thresh = cv2.threshold(a, 10, 255, cv2.THRESH_BINARY)
-        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
-        new_mask = np.zeros_like(a)
-        for i in range(1, num_labels):
-            if stats[i, cv2.CC_STAT_AREA] > island_size:
-                new_mask[labels == i] = 255
-        a_cleaned = cv2.bitwise_and(a, new_mask)
+        # Island Removal (Denoising mask), labelled at half resolution
+        # Alpha with faint values (<= 10) zeroed; any nonzero pixel counts as foreground.
+        # Written into an even-sized buffer whose odd edge row/column stays zero.
+        padded = buf["padded"]
+        a_significant = padded[:h, :w]
+        cv2.threshold(a, 10, 255, cv2.THRESH_TOZERO, dst=a_significant)
+        # 2x2 max-pool, so thin strands survive the downsample
+        small = buf["small"]
+        np.maximum(padded[0::2, 0::2], padded[0::2, 1::2], out=small)
+        np.maximum(small, padded[1::2, 0::2], out=small)
+        np.maximum(small, padded[1::2, 1::2], out=small)
+        # 16-bit labels halve the label image (and the gather below); OpenCV raises
+        # instead of wrapping if a pathological mask has more than 65534 components
+        try:
+            num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+                small, labels=buf["labels"], connectivity=8, ltype=cv2.CV_16U
+            )
+        except cv2.error:
+            num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(small, connectivity=8, ltype=cv2.CV_32S)
+        # Per-label 0/255 lookup table, applied to the label image in a single gather
+        keep = (stats[:, cv2.CC_STAT_AREA] > island_size // 4).astype(np.uint8) * 255
+        keep[0] = 0
+        small_mask = np.take(keep, labels, out=buf["small_mask"])
+        new_mask = cv2.resize(small_mask, (w2 * 2, h2 * 2), dst=buf["mask"], interpolation=cv2.INTER_NEAREST)[:h, :w]
+        # Masking the thresholded alpha applies the island filter and the threshold in one pass
+        a_cleaned = cv2.bitwise_and(a_significant, new_mask, dst=new_mask)
         
-        # Erosion (Halo removal)
+        # Edge passes only touch the kept subject's bounding box, padded with enough
+        # transparent pixels that the filters see the same neighbourhood as on the full frame
+        x, y, w, h = cv2.boundingRect(a_cleaned)
+        pad = erosion_size + 2
+        x0, y0 = max(x - pad, 0), max(y - pad, 0)
+        a_roi = a_cleaned[y0:y + h + pad, x0:x + w + pad]
+
+        # Erosion (Halo removal), in place on the scratch mask.
+        # A square erosion is separable: a row pass then a column pass gives the same result.
         if erosion_size > 0:
-            kernel = np.ones((erosion_size + 1, erosion_size + 1), np.uint8)
-            a_cleaned = cv2.erode(a_cleaned, kernel, iterations=1)
+            k = erosion_size + 1
+            cv2.erode(a_roi, np.ones((1, k), np.uint8), dst=a_roi)
+            cv2.erode(a_roi, np.ones((k, 1), np.uint8), dst=a_roi)
         
-        # Smoothing edges
-        a_cleaned = cv2.GaussianBlur(a_cleaned, (3, 3), 0)
+        # Smoothing edges (skipped when a downscale follows)
+        if smooth:
+            cv2.GaussianBlur(a_roi, (3, 3), 0, dst=a_roi)
 
-        # Content Denoising
-        clean_rgb = cv2.fastNlMeansDenoisingColored(img_np, None, 5, 5, 7, 21)
-        r_c, g_c, b_c = cv2.split(clean_rgb)
+        # Only the bounding box of the kept alpha is visible: copy (and optionally
+        # denoise) just that crop and leave the transparent pixels around it black
+        x, y, w, h = cv2.boundingRect(a_roi)
+        x, y = x + x0, y + y0
+        roi = img_np[y:y + h, x:x + w]
+        if denoise and w > 0 and h > 0:
+            roi = cv2.fastNlMeansDenoisingColored(roi, None, 5, 5, 7, 21)
 
-        final_rgba = cv2.merge([r_c, g_c, b_c, a_cleaned])
-        result_img = Image.fromarray(final_rgba)
-        
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        result_img.save(output_path)
-        return output_path
+        result_np = np.zeros(img_np.shape[:2] + (4,), np.uint8)
+        result_np[y:y + h, x:x + w, :3] = roi
+        result_np[..., 3] = a_cleaned
+        return result_np
+
+    def _scratch_buffers(self, h, w):
+        """
+        Mask buffers for an h x w alpha, allocated once per shape and thread.
+        Only the last few shapes are kept.
+        """
+        buffers = getattr(self._scratch, "buffers", None)
+        if buffers is None:
+            buffers = self._scratch.buffers = {}
+        buf = buffers.get((h, w))
+        if buf is None:
+            if len(buffers) >= 4:
+                buffers.clear()
+            h2, w2 = (h + 1) // 2, (w + 1) // 2
+            buf = buffers[(h, w)] = {
+                "padded": np.zeros((h2 * 2, w2 * 2), np.uint8),
+                "small": np.empty((h2, w2), np.uint8),
+                "labels": np.empty((h2, w2), np.uint16),
+                "small_mask": np.empty((h2, w2), np.uint8),
+                "mask": np.empty((h2 * 2, w2 * 2), np.uint8),
+            }
+        return buf
 
     def resize_image(self, input_path, output_path, target_size=(370, 320)):
         """
@@ -87,22 +470,135 @@ class StickerProcessor:
         if not os.path.exists(input_path):
             raise FileNotFoundError(f"Input file not found: {input_path}")
 
-        print(f"Resizing image: {input_path} to {target_size}")
-        img = Image.open(input_path)
         target_w, target_h = target_size
         
-        # High quality resize maintaining aspect ratio
-        img.thumbnail((target_w, target_h), Image.Resampling.LANCZOS)
-        
-        # Create canvas
-        new_canvas = Image.new("RGBA", (target_w, target_h), (0, 0, 0, 0))
-        offset = ((target_w - img.width) // 2, (target_h - img.height) // 2)
-        new_canvas.paste(img, offset)
-        
+        # Already a transparent PNG of the right size: copy instead of re-encoding
+        with Image.open(input_path) as img:
+            is_noop = img.format == "PNG" and img.mode == "RGBA" and img.size == (target_w, target_h)
+        if is_noop:
+            print(f"Image already {target_size}, copying: {input_path}")
+            if os.path.abspath(input_path) != os.path.abspath(output_path):
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                shutil.copyfile(input_path, output_path)
+            return output_path
+
+        cache_path = self._cache_path("resized", input_path, target_w, target_h)
+        if self._restore_cached(cache_path, output_path):
+            print(f"Using cached resize: {input_path} to {target_size}")
+            return output_path
+
+        print(f"Resizing image: {input_path} to {target_size}")
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        new_canvas.save(output_path)
+        if pyvips:
+            self._resize_with_vips(input_path, output_path, target_w, target_h)
+        else:
+            self._resize_with_cv2(input_path, output_path, target_w, target_h)
+        self._store_cached(output_path, cache_path)
         return output_path
 
+    def _resize_with_vips(self, input_path, output_path, target_w, target_h):
+        """
+        Resize and center on a transparent canvas using libvips (streamed, multi-threaded).
+        """
+        img = pyvips.Image.new_from_file(input_path, access="sequential")
+        if img.interpretation != "srgb":
+            img = img.colourspace("srgb")
+        if not img.hasalpha():
+            img = img.bandjoin(255)
+        
+        # Shrink only, maintaining aspect ratio (same as PIL's thumbnail)
+        scale = min(target_w / img.width, target_h / img.height, 1.0)
+        if scale < 1.0:
+            # Resample premultiplied so transparent pixels don't bleed into the edges
+            img = img.premultiply().resize(scale, kernel="lanczos3").unpremultiply().cast("uchar")
+        
+        # Center on a transparent canvas
+        left = (target_w - img.width) // 2
+        top = (target_h - img.height) // 2
+        canvas = img.embed(left, top, target_w, target_h, extend="background", background=[0, 0, 0, 0])
+        canvas.pngsave(output_path, compression=1)
+
+    def _resize_with_cv2(self, input_path, output_path, target_w, target_h):
+        """
+        Resize and center on a transparent canvas using OpenCV.
+        """
+        img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError(f"Could not read image: {input_path}")
+        if img.dtype != np.uint8:
+            img = (img >> 8).astype(np.uint8)
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+        elif img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+        cv2.imwrite(output_path, self.resize_array(img, (target_w, target_h)), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+
+    def resize_array(self, img, target_size=(370, 320)):
+        """
+        In-memory variant of resize_image.
+        Takes an HxWx4 uint8 array with alpha last (RGBA or BGRA) and returns
+        the centered canvas in the same channel order.
+        """
+        target_w, target_h = target_size
+        
+        # Shrink only, maintaining aspect ratio (same as PIL's thumbnail)
+        h, w = img.shape[:2]
+        new_size, interpolation = _fit_size(w, h, target_w, target_h)
+        if new_size != (w, h):
+            # Resample premultiplied so transparent pixels don't bleed into the edges
+            f = img.astype(np.float32)
+            f[..., :3] *= f[..., 3:] / 255
+            f = cv2.resize(f, new_size, interpolation=interpolation)
+            np.clip(f, 0, 255, out=f)
+            alpha = f[..., 3:]
+            f[..., :3] = np.where(alpha > 0, f[..., :3] * 255 / np.maximum(alpha, 1), 0)
+            img = np.clip(f, 0, 255).round().astype(np.uint8)
+        
+        # Center on a transparent canvas: pad with transparent borders in a single pass
+        h, w = img.shape[:2]
+        top, left = (target_h - h) // 2, (target_w - w) // 2
+        return cv2.copyMakeBorder(
+            img, top, target_h - h - top, left, target_w - w - left,
+            cv2.BORDER_CONSTANT, value=(0, 0, 0, 0)
+        )
+
+    def _cache_path(self, operation, input_path, *params):
+        """
+        Cache file for an operation on input_path's content with the given params.
+        """
+        if not self.cache_dir:
+            return None
+        key = "_".join([operation, f"v{_CACHE_VERSION}", _file_digest(input_path), *map(str, params)])
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def _restore_cached(self, cache_path, output_path):
+        """
+        Copies a cached result to output_path. Returns False on a cache miss.
+        """
+        if not cache_path or not os.path.exists(cache_path):
+            return False
+        if os.path.abspath(cache_path) != os.path.abspath(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            shutil.copyfile(cache_path, output_path)
+        return True
+
+    def _store_cached(self, output_path, cache_path):
+        """
+        Saves a freshly written result into the cache.
+        """
+        if cache_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Copy to a temp file and rename it into place, so an interrupted or
+            # concurrent write never leaves a truncated PNG under the cache key
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            os.close(fd)
+            try:
+                shutil.copyfile(output_path, tmp_path)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
     def generate_image(self, prompt, output_path):
         """
         Generates an image using Google Gemini Imagen API or Nano Banana (google-genai) API.
@@ -118,6 +614,12 @@ class StickerProcessor:
                 print(f"Gemini Imagen API Error: {e}")
                 print("Falling back to Nano Banana (google-genai) SDK...")
         
+        return self._generate_fallback(prompt, output_path)
+
+    def _generate_fallback(self, prompt, output_path):
+        """
+        Tries the Nano Banana SDK, then the bundled test image.
+        """
         # Try Nano Banana (google-genai SDK)
         if self.client:
             try:
@@ -129,7 +631,6 @@ class StickerProcessor:
         # Fallback to test image
         print("Warning: No API keys configured or APIs failed. Using fallback image.")
         if os.path.exists("data/input/1.jpg"):
-            import shutil
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
             shutil.copy("data/input/1.jpg", output_path)
             return output_path
@@ -140,6 +641,14 @@ class StickerProcessor:
         """
         Generate image using Google Gemini Imagen 4 API.
         """
+        url, payload = self._imagen_request(prompt)
+        response = _HTTP.post(url, json=payload)
+        return self._save_imagen_response(response, output_path)
+
+    def _imagen_request(self, prompt):
+        """
+        Builds the Imagen 4 predict URL and JSON payload for a prompt.
+        """
         url = f"https://generativelanguage.googleapis.com/v1beta/models/imagen-4.0-generate-001:predict?key={self.google_api_key}"
         
         payload = {
@@ -153,20 +662,20 @@ class StickerProcessor:
                 "personGeneration": "allow_adult"
             }
         }
-        
-        response = requests.post(url, json=payload)
-        
+        return url, payload
+
+    def _save_imagen_response(self, response, output_path):
+        """
+        Decodes an Imagen predict response and writes the image to output_path.
+        """
         if response.status_code == 200:
             result = response.json()
             # Extract base64 image from response
             if 'predictions' in result and len(result['predictions']) > 0:
-                image_data = result['predictions'][0]['bytesBase64Encoded']
-                image_bytes = base64.b64decode(image_data)
-                
-                # Save image
+                # Decode straight into the file without keeping extra copies around
                 os.makedirs(os.path.dirname(output_path), exist_ok=True)
                 with open(output_path, 'wb') as f:
-                    f.write(image_bytes)
+                    f.write(base64.b64decode(result['predictions'][0]['bytesBase64Encoded']))
                 
                 print(f"Image generated successfully with Gemini Imagen")
                 return output_path
@@ -181,6 +690,7 @@ class StickerProcessor:
         """
         if not self.client:
             raise ImportError("google-genai package not installed or GOOGLE_API_KEY missing.")
+        _, types = _load_genai()
             
         response = self.client.models.generate_images(
             model='imagen-4.0-generate-001',
@@ -217,8 +727,9 @@ class StickerProcessor:
 
         print(f"Generating image-to-image for prompt: '{prompt}' using base image: {base_image_path}")
         
-        if not genai or not self.client:
+        if not self.client:
             raise ImportError("google-genai package not installed or GOOGLE_API_KEY missing.")
+        _, types = _load_genai()
 
         # Load the base image as PIL Image
         base_image = Image.open(base_image_path).convert("RGB")
@@ -259,12 +770,237 @@ class StickerProcessor:
         """
         Checks if an image already has a transparent background.
         """
-        img = Image.open(input_path)
-        if img.mode == 'RGBA':
-            # Check if any pixel has an alpha value < 255
-            extrema = img.getextrema()
-            if extrema[3][0] < 255:
-                return True
-        return False
+        with Image.open(input_path) as img:
+            # Answered from the header alone for images without any alpha (e.g. JPEGs)
+            if img.mode in ('RGBA', 'LA', 'PA'):
+                alpha = img.getchannel('A')
+            elif 'transparency' in img.info:
+                # Palette/RGB images with a tRNS chunk
+                alpha = img.convert('RGBA').getchannel('A')
+            else:
+                return False
+            # Check if any pixel has an alpha value < 255 (alpha band only)
+            alpha_min, _ = alpha.getextrema()
+            return alpha_min < 255
 
-    
\ No newline at end of file
+    
+
+    def create_sticker(self, prompt, name, target_size=(370, 320)):
+        """
+        Runs the full sticker workflow for a single prompt without the agent:
+        generate, check background, remove it if needed, then resize.
+        The generated image and final sticker use the same naming as the agent tools.
+        """
+        source = self.generate_image(prompt, os.path.join("data", "input", f"{name}.png"))
+        return self.finish_sticker(source, os.path.join("data", "output", f"{name}_resized.png"), target_size)
+
+    def finish_sticker(self, input_path, output_path, target_size=(370, 320)):
+        """
+        Removes the background (if needed) and resizes in memory, so the
+        intermediate no-background image is never encoded to PNG and read back.
+        """
+        if self.has_transparency(input_path):
+            return self.resize_image(input_path, output_path, target_size)
+
+        return self.finish_stickers([(input_path, output_path)], target_size)[0]
+
+    def finish_stickers(self, inputs, target_size=(370, 320), return_exceptions=False):
+        """
+        Batched variant of finish_sticker for a list of (input_path, output_path) pairs.
+        Images that need background removal are segmented in batches of up to 8.
+        Each input succeeds or fails on its own: with return_exceptions=True the
+        returned list holds the exception for a failed input in place of its path,
+        otherwise the first failure is raised once all inputs have been processed.
+        """
+        results = [None] * len(inputs)
+        pending = []
+        for i, (input_path, output_path) in enumerate(inputs):
+            try:
+                if self.has_transparency(input_path):
+                    results[i] = self.resize_image(input_path, output_path, target_size)
+                else:
+                    # Outputs are sticker-sized, so inputs only need decoding at the model's resolution
+                    pending.append((i, output_path, _read_rgb(input_path, min_side=_MODEL_SIDE)))
+            except Exception as e:
+                results[i] = e
+
+        if pending:
+            print(f"Removing background and resizing {len(pending)} image(s)")
+        images = [img_np for _, _, img_np in pending]
+        try:
+            alphas = self._segment(images)
+        except Exception:
+            # Find out which inputs fail on their own instead of failing them all
+            alphas = []
+            for img_np in images:
+                try:
+                    alphas.append(self._segment([img_np])[0])
+                except Exception as e:
+                    alphas.append(e)
+
+        for (i, output_path, img_np), a in zip(pending, alphas):
+            try:
+                if isinstance(a, Exception):
+                    raise a
+                cutout = self._clean_cutout(img_np, a, 1, 50, False, smooth=False)
+                results[i] = _write_rgba(output_path, self.resize_array(cutout, target_size))
+            except Exception as e:
+                results[i] = e
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def process_files(self, inputs, target_size=(370, 320), erosion_size=1, island_size=50, denoise=False):
+        """
+        Streaming variant of finish_stickers for a list of (input_path, output_path) pairs.
+        Runs three overlapping stages in their own threads: load + segment (model),
+        mask cleanup + optional denoise (CPU), resize + write (disk). Bounded queues
+        between the stages keep at most a couple of images in flight.
+        Returns a list aligned with inputs holding either the final sticker path
+        or the exception raised for that input.
+        """
+        results = [None] * len(inputs)
+        segmented = queue.Queue(maxsize=2)
+        cleaned = queue.Queue(maxsize=2)
+
+        def segment():
+            try:
+                for i, (input_path, _) in enumerate(inputs):
+                    try:
+                        if self.has_transparency(input_path):
+                            # Already transparent: only needs the resize stage
+                            segmented.put((i, None, None))
+                            continue
+                        img_np = _read_rgb(input_path, min_side=_MODEL_SIDE)
+                        with self._inference():
+                            result_rgba = self.pipe(Image.fromarray(img_np))
+                        segmented.put((i, img_np, np.asarray(result_rgba.getchannel("A"))))
+                    except Exception as e:
+                        results[i] = e
+            finally:
+                segmented.put(None)
+
+        def clean():
+            try:
+                while True:
+                    item = segmented.get()
+                    if item is None:
+                        break
+                    i, img_np, a = item
+                    try:
+                        cutout = None if img_np is None else self._clean_cutout(img_np, a, erosion_size, island_size, denoise, smooth=False)
+                        cleaned.put((i, cutout))
+                    except Exception as e:
+                        results[i] = e
+            finally:
+                cleaned.put(None)
+
+        workers = [threading.Thread(target=stage, daemon=True) for stage in (segment, clean)]
+        for worker in workers:
+            worker.start()
+
+        # Resize + write runs on the calling thread
+        while True:
+            item = cleaned.get()
+            if item is None:
+                break
+            i, cutout = item
+            input_path, output_path = inputs[i]
+            try:
+                if cutout is None:
+                    results[i] = self.resize_image(input_path, output_path, target_size)
+                else:
+                    results[i] = _write_rgba(output_path, self.resize_array(cutout, target_size))
+            except Exception as e:
+                results[i] = e
+
+        for worker in workers:
+            worker.join()
+        return results
+
+    # --- Async API ---
+
+    async def agenerate_image(self, prompt, output_path, client=None):
+        """
+        Async variant of generate_image.
+        The Imagen REST call is awaited on an httpx.AsyncClient (a temporary one
+        if none is passed); the SDK and test image fallbacks run in a worker thread.
+        """
+        print(f"Generating image for prompt: '{prompt}'")
+        
+        if self.google_api_key:
+            try:
+                return await self._agenerate_with_gemini_imagen(prompt, output_path, client)
+            except Exception as e:
+                print(f"Gemini Imagen API Error: {e}")
+                print("Falling back to Nano Banana (google-genai) SDK...")
+        
+        return await asyncio.to_thread(self._generate_fallback, prompt, output_path)
+
+    async def _agenerate_with_gemini_imagen(self, prompt, output_path, client=None):
+        """
+        Async variant of _generate_with_gemini_imagen.
+        """
+        url, payload = self._imagen_request(prompt)
+        if client is None:
+            async with httpx.AsyncClient(http2=True, timeout=60) as own_client:
+                response = await own_client.post(url, json=payload)
+        else:
+            response = await client.post(url, json=payload)
+        return self._save_imagen_response(response, output_path)
+
+    async def aremove_background(self, input_path, output_path, **kwargs):
+        """
+        Async variant of remove_background, run in a worker thread.
+        """
+        return await asyncio.to_thread(self.remove_background, input_path, output_path, **kwargs)
+
+    async def aresize_image(self, input_path, output_path, target_size=(370, 320)):
+        """
+        Async variant of resize_image, run in a worker thread.
+        """
+        return await asyncio.to_thread(self.resize_image, input_path, output_path, target_size)
+
+    async def acreate_sticker(self, prompt, name, target_size=(370, 320), client=None):
+        """
+        Async variant of create_sticker.
+        """
+        source = await self.agenerate_image(prompt, os.path.join("data", "input", f"{name}.png"), client)
+        output_path = os.path.join("data", "output", f"{name}_resized.png")
+        return await asyncio.to_thread(self.finish_sticker, source, output_path, target_size)
+
+    async def process_batch(self, prompts, target_size=(370, 320), max_concurrency=4):
+        """
+        Creates one sticker per prompt, overlapping the image generation calls.
+        At most max_concurrency generations are in flight at once; the generated
+        images then go through background removal in one finish_stickers call.
+        Returns a list aligned with prompts holding either the final sticker
+        path or the exception raised for that prompt.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        batch_id = new_batch_id()
+
+        async with httpx.AsyncClient(http2=True, timeout=60, limits=_HTTP_LIMITS) as client:
+            async def generate(i, prompt):
+                async with semaphore:
+                    return await self.agenerate_image(prompt, os.path.join("data", "input", f"{batch_id}_{i}.png"), client)
+
+            results = await asyncio.gather(
+                *[generate(i, prompt) for i, prompt in enumerate(prompts)],
+                return_exceptions=True
+            )
+
+        generated = [
+            (i, (source, os.path.join("data", "output", f"{batch_id}_{i}_resized.png")))
+            for i, source in enumerate(results)
+            if not isinstance(source, BaseException)
+        ]
+        finished = await asyncio.to_thread(
+            self.finish_stickers, [pair for _, pair in generated], target_size, return_exceptions=True
+        )
+        for (i, _), result in zip(generated, finished):
+            results[i] = result
+        return results
@@ -4,6 +4,12 @@ from typing import Optional
 from app.services.processor import StickerProcessor
 import os
 import json
+import threading
+try:
+    # Much faster JSON parser; its decode errors subclass json.JSONDecodeError
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- Input Schemas ---
 
@@ -12,6 +18,7 @@ class RemoveBackgroundInput(BaseModel):
     output_path: Optional[str] = Field(default=None, description="The path where the background-removed image should be saved. If not provided, it will save to data/output/nobg_[input_filename].png")
     erosion_size: int = Field(default=1, description="Size for edge erosion to remove halos. 0-3 is typical.")
     island_size: int = Field(default=100, description="Minimum area for a connected component to be kept. Helps remove noise/specks.")
+    denoise: bool = Field(default=False, description="Run slow non-local means denoising on the image colors. Only enable for noisy or grainy source images.")
 
 class ResizeImageInput(BaseModel):
     input_path: str = Field(description="The full path or filename of the image to resize.")
@@ -34,13 +41,41 @@ class ImageToImageInput(BaseModel):
 # --- Processor Singleton ---
 
 _processor = None
+_processor_lock = threading.Lock()
 
 def get_processor():
     global _processor
     if _processor is None:
-        _processor = StickerProcessor()
+        with _processor_lock:
+            if _processor is None:
+                _processor = StickerProcessor()
     return _processor
 
+def _preload_processor():
+    """Loads and warms up the RMBG model so the first tool call isn't cold."""
+    try:
+        get_processor().warm_up()
+    except Exception as e:
+        print(f"Model preload failed: {str(e)}")
+
+# Warm the model in the background at import; set PRELOAD_MODEL=0 to disable
+if os.getenv("PRELOAD_MODEL", "1") == "1":
+    threading.Thread(target=_preload_processor, name="preload-rmbg", daemon=True).start()
+
+# --- Path Resolution ---
+
+def _resolve_path(raw, search_dirs, default_dir=None):
+    """
+    Resolves a bare filename against search_dirs: the first directory that
+    contains it wins, otherwise it resolves to default_dir (the first search
+    directory if not given).
+    """
+    for directory in search_dirs:
+        candidate = os.path.join(directory, raw)
+        if os.path.exists(candidate):
+            return candidate
+    return os.path.join(default_dir or search_dirs[0], raw)
+
 # --- Tool Definitions ---
 
 @tool("generate_image", args_schema=GenerateImageInput, return_direct=False)
@@ -97,7 +132,8 @@ def remove_background_tool(
     input_path: str,
     output_path: Optional[str] = None,
     erosion_size: int = 1,
-    island_size: int = 100
+    island_size: int = 100,
+    denoise: bool = False
 ) -> str:
     """
     Removes the background from an image using AI segmentation, creating a transparent PNG.
@@ -110,6 +146,8 @@ def remove_background_tool(
         output_path: Optional output path (auto-generated if not provided)
         erosion_size: Edge erosion to remove halos (0-3 recommended, default 1)
         island_size: Minimum pixel area to keep (removes noise, default 100)
+        denoise: Denoise image colors (slow, default False). Leave disabled for
+            generated images; only enable for noisy photos or grainy scans.
     
     Returns:
         Success message with output file path or error message
@@ -128,7 +166,8 @@ def remove_background_tool(
             input_path=input_path,
             output_path=output_path,
             erosion_size=erosion_size,
-            island_size=island_size
+            island_size=island_size,
+            denoise=denoise
         )
         return f"Background removed successfully. File saved at: {final_path}. NEXT: Call 'resize_for_sticker' on this file."
     except Exception as e:
@@ -159,10 +198,7 @@ def resize_image_tool(
     if not os.path.isabs(input_path) and not (input_path.startswith("data/input") or input_path.startswith("data/output")):
         # If it's just a filename, assume it's in data/output (where removed bg images go)
         # but also check data/input just in case.
-        if os.path.exists(os.path.join("data", "output", input_path)):
-            input_path = os.path.join("data", "output", input_path)
-        else:
-            input_path = os.path.join("data", "input", input_path)
+        input_path = _resolve_path(input_path, (os.path.join("data", "output"),), default_dir=os.path.join("data", "input"))
 
     if output_path is None:
         filename = os.path.basename(input_path)
@@ -195,13 +231,8 @@ def image_to_image_tool(prompt: str, base_image_path: str, output_filename: str)
         Success message with path or error message
     """
     if not os.path.isabs(base_image_path) and not base_image_path.startswith("data/"):
-        # Check both input and output directories
-        if os.path.exists(os.path.join("data", "input", base_image_path)):
-            base_image_path = os.path.join("data", "input", base_image_path)
-        elif os.path.exists(os.path.join("data", "output", base_image_path)):
-            base_image_path = os.path.join("data", "output", base_image_path)
-        else:
-            base_image_path = os.path.join("data", "input", base_image_path) # Default to input
+        # Check both input and output directories, defaulting to input
+        base_image_path = _resolve_path(base_image_path, (os.path.join("data", "input"), os.path.join("data", "output")))
 
     output_path = os.path.join("data", "output", output_filename)
     processor = get_processor()
@@ -234,19 +265,14 @@ def read_prompt_file_tool(file_path: str) -> str:
     # Resolve the file path
     if not os.path.isabs(file_path) and not file_path.startswith("data/"):
         # Check data/prompts/ first, then data/input/
-        if os.path.exists(os.path.join("data", "prompts", file_path)):
-            file_path = os.path.join("data", "prompts", file_path)
-        elif os.path.exists(os.path.join("data", "input", file_path)):
-            file_path = os.path.join("data", "input", file_path)
-        else:
-            file_path = os.path.join("data", "prompts", file_path)
-
-    if not os.path.exists(file_path):
-        return f"Error: Prompt file not found: {file_path}"
+        file_path = _resolve_path(file_path, (os.path.join("data", "prompts"), os.path.join("data", "input")))
 
     try:
-        with open(file_path, "r") as f:
-            data = json.load(f)
+        with open(file_path, "rb") as f:
+            content = f.read()
+        data = orjson.loads(content) if orjson else json.loads(content)
+    except FileNotFoundError:
+        return f"Error: Prompt file not found: {file_path}"
     except json.JSONDecodeError as e:
         return f"Error: Invalid JSON in {file_path}: {e}"
 
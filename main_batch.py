@@ -0,0 +1,46 @@
+import os
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+def main():
+    """
+    Batch version of the Sticker Creator.
+    Creates one sticker per prompt given on the command line, processing
+    all prompts concurrently without the conversational agent.
+    """
+    prompts = [p for p in sys.argv[1:] if p.strip()]
+    if not prompts:
+        print('Usage: python main_batch.py "a cute cat" "a waving bear" ...')
+        return 1
+
+    # Imported here so the usage exit doesn't start the background model preload
+    from app.agent import create_batch_sticker_graph
+
+    # Ensure necessary directories exist
+    os.makedirs("data/input", exist_ok=True)
+    os.makedirs("data/output", exist_ok=True)
+
+    graph = create_batch_sticker_graph()
+
+    print("=" * 60)
+    print(f"🎨 Sticker Creator - BATCH MODE ({len(prompts)} prompts)")
+    print("=" * 60)
+
+    # Caps the concurrent image generation calls; segmentation runs once, batched
+    response = graph.invoke({"prompts": prompts}, {"max_concurrency": 4})
+
+    failed = 0
+    for result in response["results"]:
+        if "error" in result:
+            failed += 1
+            print(f"❌ {result['prompt']}: {result['error']}")
+        else:
+            print(f"✅ {result['prompt']}: {result['path']}")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
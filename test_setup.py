@@ -7,6 +7,9 @@ and using the latest LangGraph patterns.
 import sys
 import os
 
+# Only checks that imports resolve; don't load the RMBG model in the background
+os.environ.setdefault("PRELOAD_MODEL", "0")
+
 def test_imports():
     """Test if all required packages are installed."""
     print("🔍 Testing imports...")